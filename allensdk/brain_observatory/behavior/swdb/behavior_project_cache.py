@@ -3,8 +3,8 @@ import pandas as pd
 import numpy as np
 import json
 import re
+import pynwb
 
-from allensdk import one
 from allensdk.brain_observatory.behavior.behavior_ophys_api.behavior_ophys_nwb_api import BehaviorOphysNwbApi
 from allensdk.brain_observatory.behavior.behavior_ophys_session import BehaviorOphysSession
 from allensdk.core.lazy_property import LazyProperty
@@ -12,11 +12,62 @@ from allensdk.brain_observatory.behavior.trials_processing import calculate_rewa
 from allensdk.brain_observatory.behavior.image_api import ImageApi
 from allensdk.deprecated import deprecated
 
-csv_io = {
-    'reader': lambda path: pd.read_csv(path, index_col='Unnamed: 0'),
-    'writer': lambda path, df: df.to_csv(path)
+# Low-cardinality columns of the manifest, stored as (dictionary-encoded) categoricals
+MANIFEST_CATEGORICAL_COLUMNS = [
+    'container_id',
+    'stage_name',
+    'full_genotype',
+    'targeted_structure',
+    'sex',
+    'animal_name'
+]
+
+
+# Columns of the manifest that are used to build the experiment table
+MANIFEST_COLUMNS = [
+    'ophys_experiment_id',
+    'container_id',
+    'full_genotype',
+    'imaging_depth',
+    'targeted_structure',
+    'stage_name',
+    'animal_name',
+    'sex',
+    'date_of_acquisition',
+    'retake_number'
+]
+
+
+# Order of the columns in the swdb stimulus presentations table
+STIMULUS_PRESENTATIONS_COLUMNS = [
+    'image_name',
+    'image_index',
+    'start_time',
+    'stop_time',
+    'omitted',
+    'change',
+    'duration',
+    'licks',
+    'rewards',
+    'running_speed',
+    'index',
+    'time_from_last_lick',
+    'time_from_last_reward',
+    'time_from_last_change',
+    'block_index',
+    'image_block_repetition',
+    'repeat_within_block',
+    'image_set'
+]
+
+
+# Stimulus presentations columns renamed to make more sense to students
+STIMULUS_PRESENTATIONS_RENAME = {
+    'index': 'absolute_flash_number',
+    'running_speed': 'mean_running_speed'
 }
 
+
 cache_path_example = '/allen/programs/braintv/workgroups/nc-ophys/visual_behavior/SWDB_2019/cache_20190813'
 
 
@@ -24,7 +75,7 @@ cache_path_example = '/allen/programs/braintv/workgroups/nc-ophys/visual_behavio
             "and will be removed in version 1.3. Please use brain_observatory."
             "behavior.behavior_project_cache.BehaviorProjectCache.")
 class BehaviorProjectCache(object):
-    def __init__(self, cache_base):
+    def __init__(self, cache_base, manifest_path=None):
         '''
         A cache-level object for the behavior/ophys data. Provides access to the manifest of 
         ophys/behavior containers, as well as pre-computed analysis files for each 
@@ -32,6 +83,8 @@ class BehaviorProjectCache(object):
 
         Args:
             cache_base (str): Path to the directory containing the cached behavior/ophys data
+            manifest_path (str): Path to the manifest csv. Defaults to
+                visual_behavior_data_manifest.csv in cache_base.
         
         Attributes: 
             experiment_table: (pd.DataFrame)
@@ -49,18 +102,28 @@ class BehaviorProjectCache(object):
                 object from that container, that stage as the value.
         '''
 
+        if manifest_path is None:
+            manifest_path = os.path.join(cache_base, 'visual_behavior_data_manifest.csv')
+
         self.cache_paths = {
-            'manifest_path': os.path.join(cache_base, 'visual_behavior_data_manifest.csv'),
+            'manifest_path': manifest_path,
             'nwb_base_dir': os.path.join(cache_base, 'nwb_files'),
             'analysis_files_base_dir': os.path.join(cache_base, 'analysis_files'),
             'analysis_files_metadata_path': os.path.join(cache_base, 'analysis_files_metadata.json'),
         }
 
-        self.experiment_table = csv_io['reader'](self.cache_paths['manifest_path'])
+        self.experiment_table = load_manifest(self.cache_paths['manifest_path'])
+        self.experiment_table = self.experiment_table.astype(
+            {col: 'category' for col in MANIFEST_CATEGORICAL_COLUMNS}
+        )
 
-        self.experiment_table['cre_line'] = self.experiment_table['full_genotype'].apply(parse_cre_line)
-        self.experiment_table['passive_session'] = self.experiment_table['stage_name'].apply(parse_passive)
-        self.experiment_table['image_set'] = self.experiment_table['stage_name'].apply(parse_image_set)
+        # The derived columns only depend on the few distinct genotypes and stage names
+        self.experiment_table['cre_line'] = map_categories(
+            self.experiment_table['full_genotype'], parse_cre_line).astype('category')
+        self.experiment_table['passive_session'] = map_categories(
+            self.experiment_table['stage_name'], parse_passive)
+        self.experiment_table['image_set'] = map_categories(
+            self.experiment_table['stage_name'], parse_image_set).astype('category')
 
         self.experiment_table = self.experiment_table[[
             'ophys_experiment_id',
@@ -78,6 +141,11 @@ class BehaviorProjectCache(object):
             'retake_number'
         ]]
 
+        # Group the manifest by container once, rather than on every lookup
+        self._container_groups = dict(tuple(
+            self.experiment_table.groupby('container_id', sort=False, observed=True)
+        ))
+
         self.nwb_base_dir = self.cache_paths['nwb_base_dir']
         self.analysis_files_base_dir = self.cache_paths['analysis_files_base_dir']
         self.analysis_files_metadata = self.get_analysis_files_metadata(
@@ -131,13 +199,106 @@ class BehaviorProjectCache(object):
         return session
 
     def get_container_sessions(self, container_id):
-        container_stages = {}
-        container_experiments = self.experiment_table.groupby('container_id').get_group(container_id)
-        for ind_row, row in container_experiments.iterrows():
-            container_stages.update(
-                {row['stage_name']: self.get_session(row['ophys_experiment_id'])}
-            )
-        return container_stages
+        container_experiments = self._container_groups[container_id]
+        stage_names = container_experiments['stage_name'].to_numpy()
+        experiment_ids = container_experiments['ophys_experiment_id'].to_numpy()
+        return {
+            stage_name: self.get_session(int(experiment_id))
+            for stage_name, experiment_id in zip(stage_names, experiment_ids)
+        }
+
+
+def load_manifest(path):
+    '''
+    Load the columns of the manifest needed by the cache, parsed with fixed column
+    dtypes and without the columns the cache does not use.
+
+    Args:
+        path (str): Path to the manifest csv
+    Returns:
+        manifest (pd.DataFrame): the manifest table
+    '''
+    return pd.read_csv(
+        path,
+        index_col='Unnamed: 0',
+        usecols=['Unnamed: 0'] + MANIFEST_COLUMNS,
+        dtype={'ophys_experiment_id': 'int64', 'container_id': 'int64'}
+    )
+
+
+def map_categories(column, func):
+    '''
+    Apply a function once per category of a categorical column, rather than once per row.
+
+    Args:
+        column (pd.Series): a categorical column
+        func (callable): function of a single category value
+    Returns:
+        mapped (pd.Series): func applied to the value of every row of the column;
+            NaN where the column is missing a value
+    '''
+    mapped_categories = pd.Series([func(category) for category in column.cat.categories])
+    # Missing values have the code -1, which is not a label of mapped_categories,
+    # so reindexing maps them to NaN
+    mapped = mapped_categories.reindex(column.cat.codes.to_numpy())
+    mapped.index = column.index
+    return mapped
+
+
+def get_next_flash_start_times(change_times, start_times):
+    '''
+    Args:
+        change_times (np.array): times of the stimulus changes, NaN for trials without one
+        start_times (np.array): sorted start times of the stimulus presentations
+    Returns:
+        next_flash_start_times (np.array): start time of the first stimulus presentation at or
+            after each change time, NaN if there is none
+    '''
+    if len(start_times) == 0:
+        return np.full(len(change_times), np.nan)
+    # start times are sorted, so this is a single binary search over all change times
+    next_flash_index = np.searchsorted(start_times, change_times, side='left')
+    return np.where(
+        next_flash_index < len(start_times),
+        start_times[np.minimum(next_flash_index, len(start_times) - 1)],
+        np.nan
+    )
+
+
+def get_response_latencies(lick_times, change_times):
+    '''
+    Args:
+        lick_times (np.array): object array holding the lick times of each trial
+        change_times (np.array): times of the stimulus changes, NaN for trials without one
+    Returns:
+        response_latencies (np.array): time from each change to the first lick of the trial,
+            NaN for trials without a change or without licks
+    '''
+    first_lick_times = np.array([
+        trial_lick_times[0] if len(trial_lick_times) > 0 else np.nan
+        for trial_lick_times in lick_times
+    ], dtype=float)
+    return np.where(np.isnan(change_times), np.nan, first_lick_times - change_times)
+
+
+def change_times_in_start_times(change_times, start_times):
+    '''
+    Args:
+        change_times (np.array): times of the stimulus changes, NaN for trials without one
+        start_times (np.array): sorted start times of the stimulus presentations
+    Returns:
+        in_start_times (bool): whether every (non-NaN) change time is one of the start times
+    '''
+    valid_change_times = change_times[~np.isnan(change_times)]
+    if len(valid_change_times) == 0:
+        return True
+    if len(start_times) == 0:
+        return False
+    # start times are sorted, so look each change time up by binary search
+    change_time_index = np.minimum(
+        np.searchsorted(start_times, valid_change_times), len(start_times) - 1
+    )
+    return bool((start_times[change_time_index] == valid_change_times).all())
 
 
 def parse_cre_line(full_genotype):
@@ -177,6 +338,17 @@ def parse_image_set(behavior_stage):
 
 
 class ExtendedNwbApi(BehaviorOphysNwbApi):
+
+    # Instance attributes holding the tables cached by this api, dropped by cache_clear.
+    # Public getters return copies of cached tables, so callers can modify them freely.
+    CACHE_ATTRIBUTES = [
+        '_task_parameters',
+        '_nwb_stimulus_presentations',
+        '_stimulus_presentations',
+        '_stimulus_start_times',
+        '_trials'
+    ]
+
     def __init__(self, nwb_path, trial_response_df_path, flash_response_df_path,
                  extended_stimulus_presentations_df_path):
         '''
@@ -187,6 +359,31 @@ class ExtendedNwbApi(BehaviorOphysNwbApi):
         self.flash_response_df_path = flash_response_df_path
         self.extended_stimulus_presentations_df_path = extended_stimulus_presentations_df_path
 
+    def cache_clear(self):
+        '''
+        Drop the tables cached on this api, so they are re-read on next access, and close
+        the NWB file if this api opened it.
+        '''
+        for attribute in self.CACHE_ATTRIBUTES:
+            if hasattr(self, attribute):
+                delattr(self, attribute)
+
+        # An NWBFile handed to the api (from_nwbfile) is left alone
+        if hasattr(self, '_nwb_io'):
+            self._nwb_io.close()
+            del self._nwb_io
+            del self._nwbfile
+
+    @property
+    def nwbfile(self):
+        # The base api re-opens and re-reads the NWB file on every access; open it once
+        # and reuse it for all of the tables read from this session. The file stays open
+        # until cache_clear() is called or the api is garbage collected.
+        if not hasattr(self, '_nwbfile'):
+            self._nwb_io = pynwb.NWBHDF5IO(self.path, 'r')
+            self._nwbfile = self._nwb_io.read()
+        return self._nwbfile
+
     def get_trial_response_df(self):
         tdf = pd.read_hdf(self.trial_response_df_path, key='df')
         tdf.reset_index(inplace=True)
@@ -209,12 +406,14 @@ class ExtendedNwbApi(BehaviorOphysNwbApi):
         See: https://github.com/AllenInstitute/AllenSDK/issues/637
         We need to hard-code the omitted flash fraction and stimulus duration here. 
         '''
-        task_parameters = super(ExtendedNwbApi, self).get_task_parameters()
-        task_parameters['omitted_flash_fraction'] = 0.05
-        task_parameters['stimulus_duration_sec'] = 0.25
-        task_parameters['blank_duration_sec'] = 0.5
-        task_parameters.pop('task')
-        return task_parameters
+        if not hasattr(self, '_task_parameters'):
+            task_parameters = super(ExtendedNwbApi, self).get_task_parameters()
+            task_parameters['omitted_flash_fraction'] = 0.05
+            task_parameters['stimulus_duration_sec'] = 0.25
+            task_parameters['blank_duration_sec'] = 0.5
+            task_parameters.pop('task')
+            self._task_parameters = task_parameters
+        return dict(self._task_parameters)
 
     def get_metadata(self):
         metadata = super(ExtendedNwbApi, self).get_metadata()
@@ -244,45 +443,44 @@ class ExtendedNwbApi(BehaviorOphysNwbApi):
                              'timestamps': running_speed.timestamps})
 
     def get_trials(self, filter_aborted_trials=True):
+        # Cache one table per value of filter_aborted_trials
+        filter_aborted_trials = bool(filter_aborted_trials)
+        if not hasattr(self, '_trials'):
+            self._trials = {}
+        if filter_aborted_trials not in self._trials:
+            self._trials[filter_aborted_trials] = self._build_trials(filter_aborted_trials)
+        return self._trials[filter_aborted_trials].copy()
+
+    def _build_trials(self, filter_aborted_trials):
         trials = super(ExtendedNwbApi, self).get_trials()
-        stimulus_presentations = super(ExtendedNwbApi, self).get_stimulus_presentations()
+        start_times = self._get_stimulus_start_times()
 
         # Note: everything between dashed lines is a patch to deal with timing issues in
         # the AllenSDK
         # This should be removed in the future after issues #876 and #802 are fixed.
         # --------------------------------------------------------------------------------
 
-        # gets start_time of next stimulus after timestamp in stimulus_presentations 
-        def get_next_flash(timestamp):
-            query = stimulus_presentations.query('start_time >= @timestamp')
-            if len(query) > 0:
-                return query.iloc[0]['start_time']
-            else:
-                return None
-
-        trials['change_time'] = trials['change_time'].map(lambda x: get_next_flash(x))
+        # gets start_time of next stimulus after each change time in stimulus_presentations
+        trials['change_time'] = get_next_flash_start_times(
+            trials['change_time'].to_numpy(dtype=float), start_times
+        )
 
         ### This method can lead to a NaN change time for any trials at the end of the session.
         ### However, aborted trials at the end of the session also don't have change times. 
         ### The safest method seems like just droping any trials that aren't covered by the
         ### stimulus_presentations
         # Using start time in case last stim is omitted
-        last_stimulus_presentation = stimulus_presentations.iloc[-1]['start_time']
+        last_stimulus_presentation = start_times[-1]
         trials = trials[np.logical_not(trials['stop_time'] > last_stimulus_presentation)]
 
         # recalculates response latency based on corrected change time and first lick time
-        def recalculate_response_latency(row):
-            if len(row['lick_times'] > 0) and not pd.isnull(row['change_time']):
-                return row['lick_times'][0] - row['change_time']
-            else:
-                return np.nan
-
-        trials['response_latency'] = trials.apply(recalculate_response_latency, axis=1)
+        trials['response_latency'] = get_response_latencies(
+            trials['lick_times'].to_numpy(), trials['change_time'].to_numpy(dtype=float)
+        )
         # -------------------------------------------------------------------------------
 
         # asserts that every change time exists in the stimulus_presentations table
-        for change_time in trials[trials['change_time'].notna()]['change_time']:
-            assert change_time in stimulus_presentations['start_time'].values
+        assert change_times_in_start_times(trials['change_time'].to_numpy(dtype=float), start_times)
 
         # Return only non-aborted trials from this API by default
         if filter_aborted_trials:
@@ -326,42 +524,48 @@ class ExtendedNwbApi(BehaviorOphysNwbApi):
 
         return trials
 
+    def _get_nwb_stimulus_presentations(self):
+        # The stimulus presentations stored in the NWB file, without the extended columns
+        if not hasattr(self, '_nwb_stimulus_presentations'):
+            self._nwb_stimulus_presentations = super(
+                ExtendedNwbApi, self).get_stimulus_presentations()
+        return self._nwb_stimulus_presentations
+
+    def _get_stimulus_start_times(self):
+        # Only the start times of the NWB stimulus presentations are needed to correct the trials
+        if not hasattr(self, '_stimulus_start_times'):
+            start_times = self._get_nwb_stimulus_presentations()['start_time'].to_numpy()
+            # The trial corrections look change times up by binary search
+            assert np.all(np.diff(start_times) >= 0)
+            self._stimulus_start_times = start_times
+        return self._stimulus_start_times
+
     def get_stimulus_presentations(self):
-        stimulus_presentations = super(ExtendedNwbApi, self).get_stimulus_presentations()
+        if not hasattr(self, '_stimulus_presentations'):
+            self._stimulus_presentations = self._build_stimulus_presentations()
+        return self._stimulus_presentations.copy()
+
+    def _build_stimulus_presentations(self):
+        stimulus_presentations = self._get_nwb_stimulus_presentations()
         extended_stimulus_presentations = self.get_extended_stimulus_presentations_df()
         extended_stimulus_presentations = extended_stimulus_presentations.drop(columns=['omitted'])
-        stimulus_presentations = stimulus_presentations.join(extended_stimulus_presentations)
-
-        # Reorder the columns returned to make more sense to students
-        stimulus_presentations = stimulus_presentations[[
-            'image_name',
-            'image_index',
-            'start_time',
-            'stop_time',
-            'omitted',
-            'change',
-            'duration',
-            'licks',
-            'rewards',
-            'running_speed',
-            'index',
-            'time_from_last_lick',
-            'time_from_last_reward',
-            'time_from_last_change',
-            'block_index',
-            'image_block_repetition',
-            'repeat_within_block',
-            'image_set'
-        ]]
+        # Both tables are indexed by presentation, so bind the columns side by side
+        # rather than going through a join
+        if not stimulus_presentations.index.equals(extended_stimulus_presentations.index):
+            extended_stimulus_presentations = extended_stimulus_presentations.reindex(
+                stimulus_presentations.index
+            )
+        stimulus_presentations = pd.concat(
+            [stimulus_presentations, extended_stimulus_presentations], axis=1, copy=False
+        )
 
-        # Rename some columns to make more sense to students
-        stimulus_presentations = stimulus_presentations.rename(
-            columns={'index': 'absolute_flash_number',
-                     'running_speed': 'mean_running_speed'})
+        # Reorder and rename the columns returned to make more sense to students
+        stimulus_presentations = stimulus_presentations[STIMULUS_PRESENTATIONS_COLUMNS].rename(
+            columns=STIMULUS_PRESENTATIONS_RENAME)
         # Replace image set with A/B
         stimulus_presentations['image_set'] = self.get_task_parameters()['stage'][15]
         # Change index name for easier merge with flash_response_df
-        stimulus_presentations.index.rename('flash_id', inplace=True)
+        stimulus_presentations.index = stimulus_presentations.index.rename('flash_id')
         return stimulus_presentations
 
     def get_stimulus_templates(self):
@@ -398,10 +602,12 @@ class ExtendedNwbApi(BehaviorOphysNwbApi):
         return dff_traces
 
     def get_image_index_names(self):
-        image_index_names = self.get_stimulus_presentations().groupby('image_index').apply(
-            lambda group: one(group['image_name'].unique())
-        )
-        return image_index_names
+        # image names and indices are stored in the NWB file, so the extended columns are not needed
+        image_index_names = self._get_nwb_stimulus_presentations()[
+            ['image_index', 'image_name']
+        ].drop_duplicates()
+        assert image_index_names['image_index'].is_unique, 'multiple image_names per image_index'
+        return image_index_names.set_index('image_index')['image_name'].sort_index()
 
 
 class ExtendedBehaviorSession(BehaviorOphysSession):
@@ -469,8 +675,16 @@ class ExtendedBehaviorSession(BehaviorOphysSession):
         }
 
     def get_segmentation_mask_image(self):
-        masks = self.roi_masks
-        return np.any([submask for submask in masks.values()], axis=0)
+        # OR each roi mask into a single binary image rather than stacking all of them
+        masks = list(self.roi_masks.values())
+        if len(masks) == 0:
+            # No rois, so no pixel is included in one
+            return np.zeros(np.asarray(self.max_projection).shape, dtype=np.uint8)
+        segmentation_mask_image = np.zeros(masks[0].shape, dtype=np.uint8)
+        for submask in masks:
+            np.logical_or(segmentation_mask_image, submask, out=segmentation_mask_image)
+        return segmentation_mask_image
+
 
 if __name__ == "__main__":
     cache = BehaviorProjectCache(cache_path_example)
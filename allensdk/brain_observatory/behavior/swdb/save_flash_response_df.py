@@ -312,7 +312,7 @@ if __name__=='__main__':
         # Save the flash_response_df to file
         output_fn = os.path.join(output_path, 'flash_response_df_{}.h5'.format(experiment_id))
         print('Writing flash response df to {}'.format(output_fn))
-        flash_response_df.to_hdf(output_fn, key='df', complib='bzip2', complevel=9)
+        flash_response_df.to_hdf(output_fn, key='df', complib='blosc:lz4', complevel=5)
 
     elif case==1:
         # This case is just for debugging. It computes the flash_response_df on a truncated portion of the data. 
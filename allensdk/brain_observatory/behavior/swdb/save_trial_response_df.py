@@ -240,7 +240,7 @@ if __name__=='__main__':
 
         output_fn = os.path.join(output_path, 'trial_response_df_{}.h5'.format(experiment_id))
         print('Writing trial response df to {}'.format(output_fn))
-        trial_response_df.to_hdf(output_fn, key='df', complib='bzip2', complevel=9)
+        trial_response_df.to_hdf(output_fn, key='df', complib='blosc:lz4', complevel=5)
 
     elif case == 1:
         # This is a debugging case 
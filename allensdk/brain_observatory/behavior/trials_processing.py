@@ -618,26 +618,29 @@ def find_licks(reward_times, licks, window=3.5):
 def calculate_reward_rate(response_latency=None, starttime=None, window=0.75, trial_window=25, initial_trials=10):
     assert len(response_latency) == len(starttime)
 
-    df = pd.DataFrame({'response_latency': response_latency, 'starttime':starttime})
+    response_latency = np.asarray(response_latency, dtype=float)
+    starttime = np.asarray(starttime, dtype=float)
+    n_trials = len(starttime)
 
-    # adds a column called reward_rate to the input dataframe
-    # the reward_rate column contains a rolling average of rewards/min
+    # returns a rolling average of rewards/min for each trial
     # window sets the window in which a response is considered correct, so a window of 1.0 means licks before 1.0 second are considered correct
     # Reorganized into this unit-testable form by Nick Cain April 25 2019
 
-    reward_rate = np.zeros(len(df))
+    reward_rate = np.zeros(n_trials)
     reward_rate[:initial_trials] = np.inf  # make the initial reward rate infinite, so that you include the first trials automatically.
-    for trial_number in range(initial_trials, len(df)):
 
-        min_index = np.max((0, trial_number - trial_window))
-        max_index = np.min((trial_number + trial_window, len(df)))
-        df_roll = df.iloc[min_index:max_index]
+    # rolling window of trials [min_index, max_index) around each trial after the initial ones
+    trial_number = np.arange(initial_trials, n_trials)
+    min_index = np.maximum(0, trial_number - trial_window)
+    max_index = np.minimum(trial_number + trial_window, n_trials)
 
-        correct = len(df_roll[df_roll.response_latency < window])  # get a rolling number of correct trials
-        time_elapsed = df_roll.starttime.iloc[-1] - df_roll.starttime.iloc[0]  # get the time elapsed over the trials
-        reward_rate_on_this_lap = correct / time_elapsed * 60 # calculate the reward rate, rewards/min
+    with np.errstate(invalid='ignore'):
+        is_correct = response_latency < window
+    cumulative_correct = np.concatenate([[0], np.cumsum(is_correct)])
+    correct = cumulative_correct[max_index] - cumulative_correct[min_index]  # get a rolling number of correct trials
+    time_elapsed = starttime[max_index - 1] - starttime[min_index]  # get the time elapsed over the trials
 
-        reward_rate[trial_number] = reward_rate_on_this_lap
+    reward_rate[initial_trials:] = correct / time_elapsed * 60  # calculate the reward rate, rewards/min
     return reward_rate
 
 
@@ -1,10 +1,170 @@
 import os
+import json
 import numpy as np
 import pandas as pd
 import pytest
 from allensdk.brain_observatory.behavior.swdb import behavior_project_cache as bpc
 
 
+@pytest.mark.parametrize('values, func, expected', [
+    (
+        ['Vip-IRES-Cre/wt;Ai148(TIT2L-GC6f-ICL-tTA2)/wt', 'Sst-IRES-Cre/wt;Ai148(TIT2L-GC6f-ICL-tTA2)/wt',
+         'Vip-IRES-Cre/wt;Ai148(TIT2L-GC6f-ICL-tTA2)/wt'],
+        bpc.parse_cre_line,
+        ['Vip-IRES-Cre', 'Sst-IRES-Cre', 'Vip-IRES-Cre'],
+    ),
+    (
+        ['OPHYS_1_images_A', 'OPHYS_2_images_A_passive', 'OPHYS_1_images_A'],
+        bpc.parse_passive,
+        [False, True, False],
+    ),
+    (
+        ['OPHYS_1_images_A', np.nan, 'OPHYS_4_images_B'],
+        bpc.parse_image_set,
+        ['A', np.nan, 'B'],
+    ),
+    (
+        [np.nan, np.nan],
+        bpc.parse_image_set,
+        [np.nan, np.nan],
+    ),
+])
+def test_map_categories(values, func, expected):
+    column = pd.Series(values, index=np.arange(len(values)) + 10, dtype='category')
+    mapped = bpc.map_categories(column, func)
+    pd.testing.assert_series_equal(
+        mapped, pd.Series(expected, index=column.index), check_dtype=False)
+
+
+def get_next_flash_by_query(change_time, stimulus_presentations):
+    # The per-trial lookup that get_next_flash_start_times replaced
+    query = stimulus_presentations.query('start_time >= @change_time')
+    if len(query) > 0:
+        return query.iloc[0]['start_time']
+    else:
+        return None
+
+
+@pytest.mark.parametrize('change_times, start_times', [
+    ([0.5, 1.5, 2.25, 3.0], [0.0, 0.75, 1.5, 2.25, 3.0]),
+    ([np.nan, 1.0, np.nan, 2.0], [0.0, 0.75, 1.5, 2.25, 3.0]),
+    ([-1.0, 3.5, 10.0], [0.0, 0.75, 1.5, 2.25, 3.0]),
+    ([np.nan, np.nan], [0.0, 0.75]),
+    ([1.0, np.nan], []),
+])
+def test_get_next_flash_start_times(change_times, start_times):
+    trials = pd.DataFrame({'change_time': change_times})
+    stimulus_presentations = pd.DataFrame({'start_time': np.array(start_times, dtype=float)})
+
+    expected = trials['change_time'].map(
+        lambda x: get_next_flash_by_query(x, stimulus_presentations)).to_numpy(dtype=float)
+    obtained = bpc.get_next_flash_start_times(
+        trials['change_time'].to_numpy(dtype=float),
+        stimulus_presentations['start_time'].to_numpy()
+    )
+    np.testing.assert_array_equal(obtained, expected)
+
+
+def recalculate_response_latency(row):
+    # The per-row calculation that get_response_latencies replaced
+    if len(row['lick_times'] > 0) and not pd.isnull(row['change_time']):
+        return row['lick_times'][0] - row['change_time']
+    else:
+        return np.nan
+
+
+@pytest.mark.parametrize('lick_times, change_times', [
+    ([[1.2, 1.4], [2.5], [3.1, 3.2, 3.3]], [1.0, 2.0, 3.0]),
+    ([[1.2, 1.4], [], [3.1]], [1.0, 2.0, 3.0]),
+    ([[1.2, 1.4], [2.5], [0.5]], [np.nan, 2.0, 1.0]),
+    ([[], []], [np.nan, np.nan]),
+])
+def test_get_response_latencies(lick_times, change_times):
+    trials = pd.DataFrame({
+        'lick_times': [np.array(trial_lick_times, dtype=float) for trial_lick_times in lick_times],
+        'change_time': change_times
+    })
+
+    expected = trials.apply(recalculate_response_latency, axis=1).to_numpy(dtype=float)
+    obtained = bpc.get_response_latencies(
+        trials['lick_times'].to_numpy(), trials['change_time'].to_numpy(dtype=float)
+    )
+    np.testing.assert_allclose(obtained, expected)
+
+
+@pytest.mark.parametrize('change_times, start_times', [
+    ([0.75, np.nan, 3.0], [0.0, 0.75, 1.5, 2.25, 3.0]),
+    ([0.75, 1.0], [0.0, 0.75, 1.5, 2.25, 3.0]),
+    ([3.5], [0.0, 0.75, 1.5, 2.25, 3.0]),
+    ([-1.0], [0.0, 0.75, 1.5, 2.25, 3.0]),
+    ([np.nan, np.nan], [0.0, 0.75]),
+    ([1.0], []),
+])
+def test_change_times_in_start_times(change_times, start_times):
+    change_times = np.array(change_times, dtype=float)
+    start_times = np.array(start_times, dtype=float)
+
+    expected = all(change_time in start_times for change_time in change_times[~np.isnan(change_times)])
+    assert bpc.change_times_in_start_times(change_times, start_times) == expected
+
+
+@pytest.fixture
+def local_cache_base(tmp_path):
+    manifest = pd.DataFrame({
+        'ophys_experiment_id': [792815735, 792816531, 805784331],
+        'ophys_session_id': [792680306, 792619807, 805545722],
+        'container_id': [791352433, 791352433, 803517529],
+        'full_genotype': ['Vip-IRES-Cre/wt;Ai148(TIT2L-GC6f-ICL-tTA2)/wt',
+                          'Vip-IRES-Cre/wt;Ai148(TIT2L-GC6f-ICL-tTA2)/wt',
+                          'Slc17a7-IRES2-Cre/wt;Camk2a-tTA/wt;Ai93(TITL-GCaMP6f)/wt'],
+        'imaging_depth': [175, 175, 375],
+        'targeted_structure': ['VISp', 'VISp', 'VISp'],
+        'stage_name': ['OPHYS_1_images_A', 'OPHYS_2_images_A_passive', 'OPHYS_4_images_B'],
+        'animal_name': ['Vip_403491', 'Vip_403491', 'Slc17a7_412364'],
+        'sex': ['F', 'F', 'M'],
+        'date_of_acquisition': ['2018-11-28 10:56:01', '2018-11-29 10:28:41', '2019-01-07 11:01:38'],
+        'retake_number': [0, 0, 1],
+    })
+    manifest.to_csv(str(tmp_path / 'visual_behavior_data_manifest.csv'))
+    with open(str(tmp_path / 'analysis_files_metadata.json'), 'w') as metadata_file:
+        json.dump({'response_window_duration_seconds': 0.5}, metadata_file)
+    return str(tmp_path)
+
+
+def test_local_cache_experiment_table(local_cache_base):
+    cache = bpc.BehaviorProjectCache(local_cache_base)
+    experiment_table = cache.experiment_table
+
+    assert list(experiment_table.columns) == [
+        'ophys_experiment_id', 'container_id', 'full_genotype', 'cre_line', 'imaging_depth',
+        'targeted_structure', 'image_set', 'stage_name', 'passive_session', 'animal_name',
+        'sex', 'date_of_acquisition', 'retake_number'
+    ]
+    for column in ['container_id', 'full_genotype', 'cre_line', 'targeted_structure',
+                   'image_set', 'stage_name', 'animal_name', 'sex']:
+        assert experiment_table[column].dtype.name == 'category'
+    assert experiment_table['ophys_experiment_id'].dtype == np.int64
+    assert experiment_table['passive_session'].dtype == bool
+
+    assert list(experiment_table['cre_line']) == ['Vip-IRES-Cre', 'Vip-IRES-Cre', 'Slc17a7-IRES2-Cre']
+    assert list(experiment_table['image_set']) == ['A', 'A', 'B']
+    assert list(experiment_table['passive_session']) == [False, True, False]
+    assert cache.analysis_files_metadata == {'response_window_duration_seconds': 0.5}
+
+
+def test_local_cache_container_sessions(local_cache_base, monkeypatch):
+    cache = bpc.BehaviorProjectCache(local_cache_base)
+    monkeypatch.setattr(cache, 'get_session', lambda experiment_id: experiment_id)
+
+    sessions = cache.get_container_sessions(791352433)
+    assert sessions == {'OPHYS_1_images_A': 792815735, 'OPHYS_2_images_A_passive': 792816531}
+    assert all(type(experiment_id) is int for experiment_id in sessions.values())
+
+    assert cache.get_container_sessions(803517529) == {'OPHYS_4_images_B': 805784331}
+    with pytest.raises(KeyError):
+        cache.get_container_sessions(1)
+
+
 @pytest.fixture
 def cache_test_base():
     return '/allen/programs/braintv/workgroups/nc-ophys/visual_behavior/SWDB_2019/test_data'